@@ -50,9 +50,60 @@ def build_context(item):
             + item["question"]["text"]
         )
 
-def balance_samples(n_per_bin: int = 10, buffer_size: int = 2000):
+# Characters that BPE tokenizers rarely merge, markup/code-heavy text carries many more tokens per byte
+MARKUP_CHARS = "<>/=\"'{}[]()|\\"
+MARKUP_TABLE = str.maketrans("", "", MARKUP_CHARS)
+
+def length_features(context: str):
+    """
+    Cheap length features: UTF-8 byte count and markup character count.
+    """
+    n_bytes = len(context) if context.isascii() else len(context.encode("utf-8"))
+    return n_bytes, len(context) - len(context.translate(MARKUP_TABLE))
+
+def estimate_tokens(context: str, coef) -> int:
+    """
+    Cheap length estimate: byte and markup character counts scaled by calibrated tokens-per-byte and tokens-per-markup-char.
+    """
+    n_bytes, n_markup = length_features(context)
+    return int(round(n_bytes * coef[0] + n_markup * coef[1]))
+
+def calibrate_estimator(contexts, enc, tolerance_quantile: float = 0.9, error_margin: float = 0.01):
+    """
+    Exactly tokenizes a calibration subset and fits the estimate_tokens coefficients by least squares.
+    The coefficients are fitted on the first half of `contexts` and the tolerance is measured on the held-out second half,
+    so pass a random subset. Returns (coef, tolerance, exact_counts). tolerance is an empirical relative tolerance,
+    not a bound: the `tolerance_quantile` of |estimate - exact| / estimate over the held-out half, plus `error_margin`.
+    Documents unlike the calibration subset (e.g. non-Latin text) can still be mis-estimated.
+    exact_counts holds the tiktoken counts computed along the way (aligned with contexts).
+    """
+    exact_counts = np.array([len(enc.encode(context)) for context in contexts], dtype=float)
+    features = np.array([length_features(context) for context in contexts], dtype=float)
+
+    split = max(1, len(contexts) // 2)
+    fit, holdout = slice(0, split), slice(split, None)
+    if split == len(contexts):
+        holdout = fit
+
+    # Fit relative error (rows scaled by 1/exact) so long documents don't dominate
+    weights = 1 / np.maximum(exact_counts[fit], 1)
+    coef, *_ = np.linalg.lstsq(features[fit] * weights[:, None], exact_counts[fit] * weights, rcond=None)
+    coef = np.maximum(coef, 0)
+
+    # Quantile of the residuals rather than the max, so a few outlier documents don't widen the band for everyone
+    estimates = np.maximum(features[holdout] @ coef, 1)
+    tolerance = float(np.quantile(np.abs(exact_counts[holdout] - estimates) / estimates, tolerance_quantile)) + error_margin
+    return tuple(float(c) for c in coef), tolerance, [int(t) for t in exact_counts]
+
+def balance_samples(n_per_bin: int = 10, buffer_size: int = 2000, approximate: bool = True, calibration_size: int = 100,
+                    tolerance_quantile: float = 0.9, error_margin: float = 0.01, max_refine_fraction: float = 0.5,
+                    calibration_seed: int = 0):
     """
     Loads and balances the samples in the NarrativeQA dataset to ensure each bin has approximately the same number of samples.
+    With `approximate`, lengths are estimated from byte and markup character counts (calibrated on `calibration_size`
+    exactly tokenized samples); tiktoken is only run on candidates whose estimate falls within the tolerance band of a
+    bin edge and on every example written to the manifest. Edges are recomputed as exact counts come in. Falls back to exact tokenization of the whole buffer if more than `max_refine_fraction`
+    of candidates would need refining anyway.
     """
     start_time = time.perf_counter()
 
@@ -61,31 +112,47 @@ def balance_samples(n_per_bin: int = 10, buffer_size: int = 2000):
     print("Done loading dataset!")
     enc = tiktoken.get_encoding("o200k_base") # GPT-4o standard tokenizer
 
-    # 2. Stream & Tokenize
-    print(f"Streaming and tokenizing {buffer_size} samples...")
-    examples = []
+    # 2. Stream & Build contexts (tokenization is deferred)
+    print(f"Streaming {buffer_size} samples...")
+    candidates = []
 
     for i, item in enumerate(dataset):
         if i >= buffer_size: break
 
-        # Built and encode prompt with context
+        # Built prompt with context
         context = build_context(item)
-        t_len = len(enc.encode(context))
 
         # Clean answers to strings
         ans_strings = [a["text"] for a in item["answers"]] if isinstance(item["answers"][0], dict) else item["answers"]
-        
-        # Map to formats.Example object
-        examples.append(formats.Example(
-            id=item["document"]["id"],
-            context=context,
-            question=item["question"]["text"],
-            answers=ans_strings,
-            context_tokens=t_len,
-            metadata= {"summary": item["document"]["summary"]}
-        ))
 
-        
+        candidates.append({
+            "id": item["document"]["id"],
+            "context": context,
+            "question": item["question"]["text"],
+            "answers": ans_strings,
+            "summary": item["document"]["summary"],
+            "exact": None,
+        })
+
+    # 3. Calibrate the length estimator on a subset, reusing those exact counts.
+    # Own RNG so the global random state (used for stratified selection below) is untouched
+    calib_idx = []
+    if approximate and candidates:
+        calib_rng = random.Random(calibration_seed)
+        calib_idx = calib_rng.sample(range(len(candidates)), min(calibration_size, len(candidates)))
+        coef, tolerance, calib_counts = calibrate_estimator([candidates[j]["context"] for j in calib_idx], enc, tolerance_quantile, error_margin)
+        for j, t_len in zip(calib_idx, calib_counts):
+            candidates[j]["exact"] = t_len
+        print(f"Calibrated {coef[0]:.4f} tokens/byte + {coef[1]:.4f} tokens/markup char on {len(calib_idx)} samples "
+              f"(held-out tolerance +/-{tolerance:.1%})")
+
+        for candidate in candidates:
+            candidate["estimate"] = estimate_tokens(candidate["context"], coef)
+    else:
+        tolerance = 0.0
+        for candidate in candidates:
+            candidate["exact"] = len(enc.encode(candidate["context"]))
+
     # 4. Calculate lengths and create example objects
     # print(buffer[0].keys())
     # print(buffer[0]["document"].keys())
@@ -121,25 +188,68 @@ def balance_samples(n_per_bin: int = 10, buffer_size: int = 2000):
 
     # 5. Sort and Bin logic (as we discussed previously)
 
-    # 5.1: Order samples to identify "long tail"
-    examples.sort(key=lambda x: x.context_tokens)
-    lengths = [example.context_tokens for example in examples]
-    
+    # 5.1: Natural length of each sample (exact count where known, estimate otherwise)
+    def best_length(candidate):
+        return candidate["exact"] if candidate["exact"] is not None else candidate["estimate"]
+
+    def quantile_edges():
+        return np.quantile([best_length(candidate) for candidate in candidates], np.linspace(0, 1, 11))
+
+    def bin_index(length):
+        idx = np.searchsorted(edges, length, side="right") - 1
+        return min(max(0, idx), 9)
+
     # 5.2: Calculate quantiles edges of buffer
-    edges = np.quantile(lengths, np.linspace(0, 1, 11))
+    edges = quantile_edges()
+
+    # 5.2.1: Only candidates whose estimate is within the tolerance band of an edge need an exact count to be binned.
+    # Edges move as estimates are replaced by exact counts, so repeat until no estimate is near an edge
+    if approximate and candidates:
+        refined = []
+        estimates = np.array([candidate["estimate"] for candidate in candidates])
+        while True:
+            inner_edges = edges[1:-1]
+            unknown = np.array([candidate["exact"] is None for candidate in candidates])
+            near = np.any(np.abs(estimates[:, None] - inner_edges[None, :]) <= (estimates * tolerance)[:, None], axis=1)
+            uncertain = [candidates[j] for j in np.flatnonzero(unknown & near)]
+            if not uncertain:
+                break
+
+            if len(refined) + len(uncertain) > max_refine_fraction * len(candidates):
+                print(f"Warning: tolerance band covers {len(refined) + len(uncertain)}/{len(candidates)} candidates, "
+                      "falling back to exact tokenization.")
+                uncertain = [candidate for candidate in candidates if candidate["exact"] is None]
+
+            for candidate in uncertain:
+                candidate["exact"] = len(enc.encode(candidate["context"]))
+            refined.extend(uncertain)
+            edges = quantile_edges()
+
+        n_moved = sum(bin_index(c["exact"]) != bin_index(c["estimate"]) for c in refined)
+        n_outside = sum(abs(c["exact"] - c["estimate"]) > c["estimate"] * tolerance for c in refined)
+        print(f"Exact tokenization: {len(calib_idx)} calibration + {len(refined)} refined "
+              f"({len(refined) / len(candidates):.1%} of {len(candidates)} candidates)")
+        print(f"Refined candidates: {n_moved} changed bin, {n_outside} outside the +/-{tolerance:.1%} tolerance")
+
+        # Heuristic only: refined candidates are picked by closeness to an edge, not at random
+        if refined and n_outside / len(refined) > 1 - tolerance_quantile:
+            print("Warning: refined candidates exceed the calibration tolerance more often than expected (heuristic check), "
+                  "unrefined bins may be off.")
 
     # 5.3: Stratified Selection
     # Select N samples from each bin from buffer to create final manifest
     selected_examples = []
     bins = [[] for _ in range(10)]
+    n_misbinned = 0
 
-    # 5.3.1: Segment sorted list into 10 sub-lists based on the boundaries found in the previous step
-    for example in examples:
-        idx = np.searchsorted(edges, example.context_tokens, side="right") - 1
-        idx = min(max(0, idx), 9)
-        bins[idx].append(example)
+    # 5.3.1: Order samples to identify "long tail"
+    candidates.sort(key=best_length)
 
-    # 5.3.2: From each sub-list, pick n_per_bin samples
+    # 5.3.2: Segment sorted list into 10 sub-lists based on the boundaries found in the previous step
+    for candidate in candidates:
+        bins[bin_index(best_length(candidate))].append(candidate)
+
+    # 5.3.3: From each sub-list, pick n_per_bin samples
     for i, current_bin in enumerate(bins):
         lower, upper = edges[i], edges[i+1]
 
@@ -155,17 +265,37 @@ def balance_samples(n_per_bin: int = 10, buffer_size: int = 2000):
         
         
 
-        # 5.3.3: Sample from current bin
+        # 5.3.4: Sample from current bin
         if len(current_bin) <= n_per_bin:
             # Take everything if we are under the budget for this bin
             print(f"Bin {i} ({int(lower)}-{int(upper)} tokens): Taking all {len(current_bin)} samples.")
-            selected_examples.extend(current_bin)
+            picked = current_bin
         else:
             # Downsample to keep the manifest lean and cost-aware
             print(f"Bin {i} ({int(lower)}-{int(upper)} tokens): Sampling {n_per_bin} from {len(current_bin)}.")
-            selected_examples.extend(random.sample(current_bin, n_per_bin))
+            picked = random.sample(current_bin, n_per_bin)
+
+        # 5.3.5: Map to formats.Example object, manifest token counts are always exact
+        for candidate in picked:
+            t_len = candidate["exact"]
+            if t_len is None:
+                t_len = len(enc.encode(candidate["context"]))
+                if bin_index(t_len) != i:
+                    n_misbinned += 1
+
+            selected_examples.append(formats.Example(
+                id=candidate["id"],
+                context=candidate["context"],
+                question=candidate["question"],
+                answers=candidate["answers"],
+                context_tokens=t_len,
+                metadata= {"summary": candidate["summary"]}
+            ))
 
   
+    if n_misbinned:
+        print(f"Warning: {n_misbinned}/{len(selected_examples)} selected examples have an exact count outside the bin they were drawn from.")
+
     # 5. Creates manifest so the runner can execute without re-streaming, can use pydantic for more robust serialization
 
     manifest_data = [asdict(example) for example in selected_examples]
@@ -0,0 +1,140 @@
+import sys
+import os
+import io
+import re
+import random
+import tempfile
+import time
+import types
+from contextlib import redirect_stdout
+
+import numpy as np
+
+# Ensure src is in path if running directly
+sys.path.insert(0, os.path.abspath("src"))
+
+# Stub out tiktoken, datasets and dotenv so the sampler runs offline on a synthetic buffer.
+# Timings below are for this regex stub encoder, not o200k_base.
+class CountingEncoder:
+    """Word/punctuation splitter standing in for o200k_base, records which contexts were encoded."""
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return re.findall(r"\w+|[^\w\s]", text)
+
+enc = CountingEncoder()
+sys.modules["tiktoken"] = types.SimpleNamespace(get_encoding=lambda name: enc)
+sys.modules["datasets"] = types.SimpleNamespace(load_dataset=None)
+sys.modules["dotenv"] = types.SimpleNamespace(load_dotenv=lambda: None)
+os.environ.setdefault("HF_Token", "stub")
+
+from contextcliff.data import sampler
+
+BUFFER_SIZE = 2000
+N_PER_BIN = 5
+EDGE_TOL = 0.05                       # max relative deviation of an inner edge from the exact scan
+COUNT_TOL = 0.10 * BUFFER_SIZE / 10   # max deviation of a bin's population from the exact scan
+
+BIN_LINE = re.compile(r"^Bin (\d+) \((\d+)-(\d+)(?: tokens)?\): (?:Taking all (\d+)|Sampling \d+ from (\d+)|Empty)")
+
+def fake_dataset(n, markup_share, dense_share=0.0, seed=0):
+    """
+    NarrativeQA-shaped items with log-normal lengths. A share of them is markup-heavy (captured by the estimator's
+    markup feature), another share is "dense" text whose tokens-per-byte varies per document and cannot be estimated.
+    """
+    rng = random.Random(seed)
+    vocab = ["the", "castle", "river", "whispered", "Elizabeth", "journey", "of", "and", "a", "night"]
+    items = []
+    for i in range(n):
+        n_words = int(rng.lognormvariate(7, 1)) + 20
+        words = [rng.choice(vocab) for _ in range(n_words)]
+        kind = rng.random()
+        if kind < markup_share:
+            text = " ".join(f"<p class='x'>{w}</p>" for w in words)
+        elif kind < markup_share + dense_share:
+            group = rng.randint(1, 8)
+            text = " ".join("_".join(words[j:j + group]) for j in range(0, len(words), group))
+        else:
+            text = " ".join(words) + "."
+        items.append({
+            "document": {"id": f"doc-{i}", "text": text, "summary": {"text": ""}},
+            "question": {"text": "Who crossed the river?"},
+            "answers": [{"text": "Elizabeth"}],
+        })
+    return items
+
+def run(items, approximate):
+    """Runs balance_samples on items with a fixed seed, returns samples, bin edges/counts, encode count, time and output."""
+    sampler.load_dataset = lambda *args, **kwargs: iter(items)
+    enc.encoded.clear()
+    random.seed(7)
+
+    out = io.StringIO()
+    start = time.perf_counter()
+    with redirect_stdout(out):
+        samples = sampler.balance_samples(n_per_bin=N_PER_BIN, buffer_size=BUFFER_SIZE, approximate=approximate)
+    elapsed = time.perf_counter() - start
+
+    edges, counts = [], []
+    for line in out.getvalue().splitlines():
+        match = BIN_LINE.match(line)
+        if match:
+            edges.append((int(match.group(2)), int(match.group(3))))
+            counts.append(int(match.group(4) or match.group(5) or 0))
+
+    return {"samples": samples, "edges": edges, "counts": counts, "encoded": list(enc.encoded),
+            "time": elapsed, "output": out.getvalue()}
+
+def compare_bins(approx, exact):
+    """Asserts the approximate run's inner edges and bin populations are within tolerance of the exact run."""
+    for i, ((_, a_upper), (_, e_upper)) in enumerate(zip(approx["edges"][:-1], exact["edges"][:-1])):
+        assert abs(a_upper - e_upper) <= EDGE_TOL * e_upper, f"Edge {i + 1}: {a_upper} vs exact {e_upper}"
+    for i, (a_count, e_count) in enumerate(zip(approx["counts"], exact["counts"])):
+        assert abs(a_count - e_count) <= COUNT_TOL, f"Bin {i}: {a_count} samples vs exact {e_count}"
+
+os.chdir(tempfile.mkdtemp())
+
+# Scenario 1: mostly plain text with 6% markup, estimator is used
+print(f"Scenario 1: buffer_size={BUFFER_SIZE}, 6% markup-heavy documents")
+items = fake_dataset(BUFFER_SIZE, markup_share=0.06)
+exact = run(items, approximate=False)
+approx = run(items, approximate=True)
+assert "falling back" not in approx["output"], "Unexpected fallback to exact tokenization"
+
+# (a) Manifest token counts are exact
+assert all(ex.context_tokens == len(enc.encode(ex.context)) for ex in approx["samples"]), "Manifest context_tokens not exact"
+print("Manifest context_tokens match exact encoding.")
+
+# (b) Untokenized candidates are all far from the final edges, and most of the buffer is never tokenized
+contexts = [sampler.build_context(item) for item in items]
+calib_idx = random.Random(0).sample(range(len(contexts)), 100)
+coef, tolerance, _ = sampler.calibrate_estimator([contexts[j] for j in calib_idx], enc)
+inner_edges = np.array([upper for _, upper in approx["edges"][:-1]])
+encoded = set(approx["encoded"])
+skipped = [c for c in contexts if c not in encoded]
+for c in skipped:
+    est = sampler.estimate_tokens(c, coef)
+    assert np.all(np.abs(inner_edges - est) > est * tolerance - 1), "Untokenized candidate lies near a bin edge"
+assert len(approx["encoded"]) < BUFFER_SIZE / 2, "Estimator tokenized most of the buffer"
+print(f"{len(skipped)} candidates far from bin edges were not tokenized.")
+
+# (c) Binning matches the exact scan within tolerance
+compare_bins(approx, exact)
+print(f"Edges within {EDGE_TOL:.0%} and bin populations within {int(COUNT_TOL)} of the exact scan.")
+
+print(f"Exact scan: {len(exact['encoded'])} encodes in {exact['time']:.2f}s (regex stub encoder)")
+print(f"Approximate scan: {len(approx['encoded'])} encodes in {approx['time']:.2f}s "
+      f"({exact['time'] / approx['time']:.1f}x faster, regex stub encoder)")
+
+# Scenario 2: 40% dense text, tolerance band covers most candidates so the scan must fall back to the exact result
+print(f"\nScenario 2: buffer_size={BUFFER_SIZE}, 6% markup-heavy and 40% dense documents")
+items = fake_dataset(BUFFER_SIZE, markup_share=0.06, dense_share=0.4)
+exact = run(items, approximate=False)
+approx = run(items, approximate=True)
+assert "falling back" in approx["output"], "Expected fallback to exact tokenization"
+assert approx["edges"] == exact["edges"], "Fallback edges differ from the exact scan"
+assert approx["counts"] == exact["counts"], "Fallback bin populations differ from the exact scan"
+assert [ex.id for ex in approx["samples"]] == [ex.id for ex in exact["samples"]], "Fallback manifest differs from the exact scan"
+print("Fallback edges, bin populations and manifest match the exact scan.")